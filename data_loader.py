@@ -64,16 +64,64 @@ def get_loader(args):
         exit(0)
 
     # Define dataloaders
+    # Datasets fit in memory, so a couple of workers is enough and more workers only add contention.
+    # Keep workers alive across epochs to avoid re-forking them every epoch.
+    worker_kwargs = dict(num_workers=args.n_workers,
+                         persistent_workers=args.n_workers > 0,
+                         prefetch_factor=4 if args.n_workers > 0 else None,
+                         pin_memory=args.is_cuda)
+
     train_loader = torch.utils.data.DataLoader(dataset=train,
                                                batch_size=args.batch_size,
                                                shuffle=True,
-                                               num_workers=args.n_workers,
-                                               drop_last=True)
+                                               drop_last=True,
+                                               **worker_kwargs)
 
     test_loader = torch.utils.data.DataLoader(dataset=test,
                                               batch_size=args.batch_size,
                                               shuffle=False,
-                                              num_workers=args.n_workers,
-                                              drop_last=False)
+                                              drop_last=False,
+                                              **worker_kwargs)
 
     return train_loader, test_loader
+
+
+class DataPrefetcher(object):
+    """Wraps a loader and copies the next batch to GPU on a side stream while the current batch is processed."""
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            self.next_x, self.next_y = next(self.iterator)
+        except StopIteration:
+            self.next_x, self.next_y = None, None
+            return
+
+        # Issue the host to device copy of the next batch on the side stream
+        with torch.cuda.stream(self.stream):
+            self.next_x = self.next_x.cuda(non_blocking=True)
+            self.next_y = self.next_y.cuda(non_blocking=True)
+
+    def __next__(self):
+        # Make compute stream wait for the copy of the batch about to be returned
+        torch.cuda.current_stream().wait_stream(self.stream)
+        x, y = self.next_x, self.next_y
+        if x is None:
+            raise StopIteration
+
+        # Tensors were allocated on the side stream, mark them as used by the compute stream
+        x.record_stream(torch.cuda.current_stream())
+        y.record_stream(torch.cuda.current_stream())
+
+        self.preload()
+        return x, y
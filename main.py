@@ -25,6 +25,10 @@ def update_args(args):
     args.is_cuda     = torch.cuda.is_available()  # Check GPU availability
     if args.is_cuda:
         print("Using GPU")
+        torch.backends.cudnn.benchmark        = True                 # Autotune conv algorithms for the fixed input shape
+        torch.backends.cudnn.allow_tf32       = True                 # Allow TF32 tensor cores in cuDNN
+        torch.backends.cuda.matmul.allow_tf32 = True                 # Allow TF32 tensor cores in matmuls
+        torch.set_float32_matmul_precision("high")
     else:
         print("Cuda not available.")
 
@@ -43,7 +47,7 @@ if __name__ == '__main__':
     parser.add_argument('--warmup_epochs', type=int, default=10, help='number of epochs to warmup learning rate')
     parser.add_argument('--batch_size', type=int, default=128, help='batch size')
     parser.add_argument('--n_classes', type=int, default=10, help='number of classes in the dataset')
-    parser.add_argument('--n_workers', type=int, default=4, help='number of workers for data loaders')
+    parser.add_argument('--n_workers', type=int, default=2, help='number of workers for data loaders')
     parser.add_argument('--lr', type=float, default=5e-4, help='peak learning rate')
     parser.add_argument('--output_path', type=str, default='./outputs', help='path to store training graphs and tsne plots')
 
@@ -57,6 +61,7 @@ if __name__ == '__main__':
     parser.add_argument('--model_path', type=str, default='./model', help='path to store trained model')
     parser.add_argument("--load_model", type=bool, default=False, help="load saved model")
     parser.add_argument("--precision", type=str, default='float32', choices=['float32', 'bfloat16'], help="precision for training")
+    parser.add_argument("--grad_checkpoint", action='store_true', help="recompute encoder activations during backward to allow larger batch sizes (works alongside bfloat16 and compile)")
 
     start_time = datetime.datetime.now()
     print("Started at " + str(start_time.strftime('%Y-%m-%d %H:%M:%S')))
@@ -1,39 +1,58 @@
 import os
 import torch
-import torch.nn as nn
+import torch.nn.functional as F
 from torch import optim
 import matplotlib.pyplot as plt
-from contextlib import nullcontext                    # <-- added import
-from data_loader import get_loader
+from contextlib import nullcontext
+from data_loader import get_loader, DataPrefetcher
 from vit_model import VisionTransformer
-from sklearn.metrics import accuracy_score
 
 
 class Solver(object):
     def __init__(self, args):
         self.args = args
 
+        # Hot arguments cached as plain attributes to avoid chained lookups in the training loop
+        self.is_cuda       = args.is_cuda
+        self.n_epochs      = args.epochs
+        self.warmup_epochs = args.warmup_epochs
+
         # Set precision
         self.dtype = torch.bfloat16 if args.precision == 'bfloat16' else torch.float32
 
+        # Autocast context is created once and reused for every batch
+        self.device_type  = 'cuda' if self.is_cuda else 'cpu'
+        self.autocast_ctx = torch.amp.autocast(device_type=self.device_type, dtype=self.dtype) if self.is_cuda else nullcontext()
+
+        # Device transfer and input formatting are chosen once here instead of branching every batch
+        if self.is_cuda:
+            self._to_device    = lambda t: t.cuda(non_blocking=True)
+            self._format_input = lambda x: x.contiguous(memory_format=torch.channels_last)
+        else:
+            self._to_device    = lambda t: t
+            self._format_input = lambda x: x
+
         # Get data loaders
         self.train_loader, self.test_loader = get_loader(args)
 
         # Create object of the Vision Transformer
         self.model = VisionTransformer(n_channels=3, embed_dim=128, n_layers=6, n_attention_heads=4, forward_mul=2, image_size=32, 
                                        patch_size=4, dropout=0.1, n_classes=self.args.n_classes, 
-                                       pos_embed=self.args.pos_embed, max_relative_distance=self.args.max_relative_distance)
+                                       pos_embed=self.args.pos_embed, max_relative_distance=self.args.max_relative_distance, 
+                                       grad_checkpoint=self.args.grad_checkpoint)
         
-        if self.args.is_cuda:
+        if self.is_cuda:
             self.model = self.model.cuda()
+            self.model = self.model.to(memory_format=torch.channels_last)       # NHWC layout for the patch embedding conv
 
         # Option to load pretrained model
         if self.args.load_model:
             print("Using pretrained model")
             self.model.load_state_dict(torch.load(os.path.join(self.args.model_path, 'ViT_model.pt')))
 
-        # Training loss function
-        self.loss_fn = nn.CrossEntropyLoss()
+        # Compile the model after loading weights (fixed input shape, so no dynamic shapes needed)
+        if self.is_cuda:
+            self.model = torch.compile(self.model, mode="reduce-overhead", fullgraph=False, dynamic=False)
 
         # Arrays to record training progression
         self.train_losses     = []
@@ -45,31 +64,28 @@ class Solver(object):
         # Set Vision Transformer to evaluation mode
         self.model.eval()
 
-        # Arrays to record all labels and logits
-        all_labels = []
-        all_logits = []
-
-        # Testing loop
-        for (x, y) in loader:
-            if self.args.is_cuda:
-                x = x.cuda()
-            device_type = 'cuda' if self.args.is_cuda else 'cpu'
-            ptdtype = self.dtype
-            with torch.no_grad():
-                with (nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)):
+        with torch.inference_mode():
+            # Accumulate loss sum and correct predictions on device
+            loss_sum  = torch.zeros((), device=self.device_type)
+            correct   = torch.zeros((), device=self.device_type)
+            n_samples = 0
+
+            # Testing loop
+            for (x, y) in loader:
+                x, y = self._to_device(x), self._to_device(y)
+                x = self._format_input(x)
+                with self.autocast_ctx:
                     logits = self.model(x)
 
-            all_labels.append(y)
-            all_logits.append(logits.cpu())
+                # Argmax on raw logits (softmax is order preserving)
+                logits     = logits.float()
+                loss_sum  += F.cross_entropy(logits, y, reduction='sum')
+                correct   += (logits.argmax(1)==y).sum()
+                n_samples += y.numel()
 
-        # Convert all captured variables to torch
-        all_labels = torch.cat(all_labels)
-        all_logits = torch.cat(all_logits)
-        all_pred   = all_logits.max(1)[1]
-        
-        # Compute loss, accuracy and confusion matrix
-        loss = self.loss_fn(all_logits, all_labels).item()
-        acc  = accuracy_score(y_true=all_labels, y_pred=all_pred)
+        # Compute loss and accuracy
+        loss = (loss_sum/n_samples).item()
+        acc  = (correct/n_samples).item()
         
         return acc, loss
 
@@ -86,108 +102,122 @@ class Solver(object):
         return acc, loss
 
     def train(self):
-        iters_per_epoch = len(self.train_loader)
+        iters_per_epoch   = len(self.train_loader)
+        samples_per_epoch = iters_per_epoch * self.args.batch_size      # Train loader drops the last incomplete batch
+        last_iter         = iters_per_epoch - 1
 
         # Define optimizer for training the model
-        optimizer = optim.AdamW(self.model.parameters(), lr=self.args.lr, weight_decay=1e-3)
+        # Use the fused CUDA kernel where available, else fall back to the multi-tensor implementation
+        try:
+            optimizer = optim.AdamW(self.model.parameters(), lr=self.args.lr, weight_decay=1e-3, fused=self.is_cuda)
+        except (TypeError, RuntimeError):
+            optimizer = optim.AdamW(self.model.parameters(), lr=self.args.lr, weight_decay=1e-3, foreach=True)
 
         # scheduler for linear warmup of lr and then cosine decay to 1e-5
-        linear_warmup = optim.lr_scheduler.LinearLR(optimizer, start_factor=1/self.args.warmup_epochs, end_factor=1.0, total_iters=self.args.warmup_epochs-1, last_epoch=-1, verbose=True)
-        cos_decay     = optim.lr_scheduler.CosineAnnealingLR(optimizer=optimizer, T_max=self.args.epochs-self.args.warmup_epochs, eta_min=1e-5, verbose=True)
+        linear_warmup = optim.lr_scheduler.LinearLR(optimizer, start_factor=1/self.warmup_epochs, end_factor=1.0, total_iters=self.warmup_epochs-1, last_epoch=-1)
+        cos_decay     = optim.lr_scheduler.CosineAnnealingLR(optimizer=optimizer, T_max=self.n_epochs-self.warmup_epochs, eta_min=1e-5)
+
+        # Overlap host to device copy of the next batch with compute on the current one
+        train_loader = DataPrefetcher(self.train_loader) if self.is_cuda else self.train_loader
+
+        # Checkpoint path is fixed for the whole run
+        model_file = os.path.join(self.args.model_path, f"ViT_model_{self.args.pos_embed}.pt")
 
         # Variable to capture best test accuracy
         best_acc = 0
 
         # Training loop
-        for epoch in range(self.args.epochs):
+        for epoch in range(self.n_epochs):
 
             # Set model to training mode
             self.model.train()
 
-            # Arrays to record epoch loss and accuracy
-            train_epoch_loss     = []
-            train_epoch_accuracy = []
+            # Accumulate epoch loss and correct predictions on device to avoid a sync every batch
+            train_epoch_loss    = torch.zeros((), device=self.device_type)
+            train_epoch_correct = torch.zeros((), device=self.device_type)
 
-            # Loop on loader
-            for i, (x, y) in enumerate(self.train_loader):
+            # Loop on loader (batches are pushed to GPU ahead of time by the prefetcher)
+            for i, (x, y) in enumerate(train_loader):
 
-                # Push to GPU and set precision
-                if self.args.is_cuda:
-                    x, y = x.cuda(), y.cuda()
-                device_type = 'cuda' if self.args.is_cuda else 'cpu'
-                ptdtype = self.dtype
+                # Set memory format and precision
+                x = self._format_input(x)
 
-                with (nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)):
+                with self.autocast_ctx:
                     # Get output logits from the model 
                     logits = self.model(x)
 
                     # Compute training loss
-                    loss = self.loss_fn(logits, y)
+                    loss = F.cross_entropy(logits, y)
 
                 # Updating the model
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
                 loss.backward()
                 optimizer.step()
 
                 # Batch metrics
                 batch_pred            = logits.max(1)[1]
-                batch_accuracy        = (y==batch_pred).float().mean()
-                train_epoch_loss     += [loss.item()]
-                train_epoch_accuracy += [batch_accuracy.item()]
+                batch_correct         = (y==batch_pred).sum()
+                train_epoch_loss     += loss.detach()
+                train_epoch_correct  += batch_correct
 
-                # Log training progress
-                if i % 50 == 0 or i == (iters_per_epoch - 1):
-                    print(f'Ep: {epoch+1}/{self.args.epochs}\tIt: {i+1}/{iters_per_epoch}\tbatch_loss: {loss:.4f}\tbatch_accuracy: {batch_accuracy:.2%}')
+                # Log training progress (only logging iterations synchronize with the GPU)
+                log_this = (i % 50 == 0) or (i == last_iter)
+                if log_this:
+                    batch_accuracy = batch_correct.item() / y.numel()
+                    print(f'Ep: {epoch+1}/{self.n_epochs}\tIt: {i+1}/{iters_per_epoch}\tbatch_loss: {loss.item():.4f}\tbatch_accuracy: {batch_accuracy:.2%}')
 
             # Test the test set after every epoch
             test_acc, test_loss = self.test(train=((epoch+1)%25==0))  # Test training set every 25 epochs
 
+            # Save model only on a new best test accuracy (write to temp file then replace for atomicity)
+            if test_acc > best_acc:
+                torch.save(getattr(self.model, '_orig_mod', self.model).state_dict(), model_file + '.tmp')
+                os.replace(model_file + '.tmp', model_file)
+
             # Capture best test accuracy
             best_acc = max(test_acc, best_acc)
-            print(f"Best test acc: {best_acc:.2%}\n")
-
-            # Save model
-            torch.save(self.model.state_dict(), os.path.join(self.args.model_path, f"ViT_model_{self.args.pos_embed}.pt"))
+            print(f"Best test acc: {best_acc:.2%}\tLR: {optimizer.param_groups[0]['lr']:.2e}\n")
             
             # Update learning rate using schedulers
-            if epoch < self.args.warmup_epochs:
+            if epoch < self.warmup_epochs:
                 linear_warmup.step()
             else:
                 cos_decay.step()
 
             # Update training progression metric arrays
-            self.train_losses     += [sum(train_epoch_loss)/iters_per_epoch]
+            self.train_losses     += [(train_epoch_loss/iters_per_epoch).item()]
             self.test_losses      += [test_loss]
-            self.train_accuracies += [sum(train_epoch_accuracy)/iters_per_epoch]
+            self.train_accuracies += [(train_epoch_correct/samples_per_epoch).item()]
             self.test_accuracies  += [test_acc]
 
     def plot_graphs(self):
         # Plot graph of loss values
-        plt.plot(self.train_losses, color='b', label='Train')
-        plt.plot(self.test_losses, color='r', label='Test')
+        fig, ax = plt.subplots()
+        ax.plot(self.train_losses, color='b', label='Train')
+        ax.plot(self.test_losses, color='r', label='Test')
 
-        plt.ylabel('Loss', fontsize = 18)
-        plt.yticks(fontsize=16)
-        plt.xlabel('Epoch', fontsize = 18)
-        plt.xticks(fontsize=16)
-        plt.legend(fontsize=15, frameon=False)
+        ax.set_ylabel('Loss', fontsize = 18)
+        ax.tick_params(axis='y', labelsize=16)
+        ax.set_xlabel('Epoch', fontsize = 18)
+        ax.tick_params(axis='x', labelsize=16)
+        ax.legend(fontsize=15, frameon=False)
 
         # plt.show()  # Uncomment to display graph
-        plt.savefig(os.path.join(self.args.output_path, f'graph_loss_{self.args.pos_embed}.png'), bbox_inches='tight')
-        plt.close('all')
+        fig.savefig(os.path.join(self.args.output_path, f'graph_loss_{self.args.pos_embed}.png'), bbox_inches='tight')
+        plt.close(fig)
 
 
         # Plot graph of accuracies
-        plt.plot(self.train_accuracies, color='b', label='Train')
-        plt.plot(self.test_accuracies, color='r', label='Test')
+        fig, ax = plt.subplots()
+        ax.plot(self.train_accuracies, color='b', label='Train')
+        ax.plot(self.test_accuracies, color='r', label='Test')
 
-        plt.ylabel('Accuracy', fontsize = 18)
-        plt.yticks(fontsize=16)
-        plt.xlabel('Epoch', fontsize = 18)
-        plt.xticks(fontsize=16)
-        plt.legend(fontsize=15, frameon=False)
+        ax.set_ylabel('Accuracy', fontsize = 18)
+        ax.tick_params(axis='y', labelsize=16)
+        ax.set_xlabel('Epoch', fontsize = 18)
+        ax.tick_params(axis='x', labelsize=16)
+        ax.legend(fontsize=15, frameon=False)
 
         # plt.show()  # Uncomment to display graph
-        plt.savefig(os.path.join(self.args.output_path, f'graph_accuracy_{self.args.pos_embed}.png'), bbox_inches='tight')
-        plt.close('all')
-
+        fig.savefig(os.path.join(self.args.output_path, f'graph_accuracy_{self.args.pos_embed}.png'), bbox_inches='tight')
+        plt.close(fig)
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from positional_encodings.pos_embed_none import EmbedLayerWithNone
 from positional_encodings.pos_embed_learn import EmbedLayerWithLearn
 from positional_encodings.pos_embed_sinusoidal import EmbedLayerWithSinusoidal
@@ -100,8 +101,9 @@ class Classifier(nn.Module):
 
 
 class VisionTransformer(nn.Module):
-    def __init__(self, n_channels, embed_dim, n_layers, n_attention_heads, forward_mul, image_size, patch_size, n_classes, dropout=0.1, pos_embed='learn', max_relative_distance=2):
+    def __init__(self, n_channels, embed_dim, n_layers, n_attention_heads, forward_mul, image_size, patch_size, n_classes, dropout=0.1, pos_embed='learn', max_relative_distance=2, grad_checkpoint=False):
         super().__init__()
+        self.grad_checkpoint = grad_checkpoint                                          # Recompute encoder activations in backward to save memory
 
         # 
         if pos_embed == 'learn':
@@ -126,7 +128,10 @@ class VisionTransformer(nn.Module):
     def forward(self, x):
         x = self.embedding(x)
         for block in self.encoder:
-            x = block(x)
+            if self.grad_checkpoint and self.training:
+                x = checkpoint(block, x, use_reentrant=False)                           # Blocks are nn.Modules, so torch.compile still captures them
+            else:
+                x = block(x)
         x = self.norm(x)
         x = self.classifier(x)
         return x